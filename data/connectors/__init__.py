@@ -0,0 +1,19 @@
+_connector = None
+
+
+def get_connector():
+    """
+    Return the PolygonConnector shared by every pipeline in this process,
+    creating it on first use.
+
+    Sharing it keeps a single set of keep-alive connections and a single
+    rate limiter no matter how many pipelines run.
+    """
+    global _connector
+    if _connector is None:
+        # imported here so that using the S3 connector alone doesn't
+        # require the polygon client
+        from data.connectors.polygon_connector import PolygonConnector
+
+        _connector = PolygonConnector()
+    return _connector
@@ -1,7 +1,132 @@
 from polygon import RESTClient
+from polygon.exceptions import BadResponse
+from urllib3.exceptions import MaxRetryError
 import os
+import threading
+import time
+
+try:
+    # orjson decodes responses several times faster than the stdlib json module
+    import orjson as json_module
+except ImportError:
+    json_module = None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` tokens per second, holding at
+    most `capacity` tokens (defaults to one second's worth).
+
+    Take a token before every request, either with `acquire()` or by using the
+    bucket as a context manager.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """Block until `n` tokens are available and take them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                wait = (n - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _ThrottledPool:
+    """
+    Mixin for urllib3 connection pools taking a token from `limiter` before
+    every request. urllib3 retries 429 and 5xx responses by calling urlopen
+    again, so each retry takes a token as well.
+    """
+
+    limiter = None
+
+    def urlopen(self, *args, **kwargs):
+        with self.limiter:
+            return super().urlopen(*args, **kwargs)
+
+
+def _is_rate_limited(error):
+    """Whether an error raised by the Polygon client was caused by throttling."""
+    if isinstance(error, MaxRetryError):
+        return "429" in str(error.reason)
+    return isinstance(error, BadResponse) and "exceeded the maximum" in str(error)
 
 
 class PolygonConnector:
-    def __init__(self):
-        self.client = RESTClient(os.getenv("POLYGON_API_KEY"))
+    # Polygon doesn't throttle paid plans below ~100 requests per second.
+    # Plans with a lower limit set POLYGON_REQUESTS_PER_SECOND instead
+    REQUESTS_PER_SECOND = 50
+    MAX_RETRIES = 5
+    # Keep-alive connections per host, enough for every worker thread
+    POOL_SIZE = 32
+
+    def __init__(self, requests_per_second=None):
+        if requests_per_second is None:
+            requests_per_second = float(
+                os.getenv("POLYGON_REQUESTS_PER_SECOND", self.REQUESTS_PER_SECOND)
+            )
+        self.client = RESTClient(
+            os.getenv("POLYGON_API_KEY"), retries=5, custom_json=json_module
+        )
+        # shared by every thread using this connector
+        self.limiter = TokenBucket(requests_per_second)
+
+        for client in (self.client, self.client.vx):
+            pool = client.client
+            # urllib3 keeps a single connection per host by default and
+            # discards any extra ones, so concurrent threads would pay a new
+            # TLS handshake on almost every request
+            pool.connection_pool_kw["maxsize"] = self.POOL_SIZE
+            # the client fetches further pages lazily while its results are
+            # iterated, so throttle at the HTTP layer to cover every page
+            pool.pool_classes_by_scheme = {
+                scheme: type(
+                    pool_class.__name__,
+                    (_ThrottledPool, pool_class),
+                    {"limiter": self.limiter},
+                )
+                for scheme, pool_class in pool.pool_classes_by_scheme.items()
+            }
+
+    def fetch(self, method, **params):
+        """
+        Call one of the client's methods and return its result.
+
+        Every request is throttled by the connector's limiter; on top of that
+        the call is retried with exponential backoff when Polygon reports the
+        rate limit was exceeded.
+        """
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                return method(**params)
+            except (BadResponse, MaxRetryError) as e:
+                if not _is_rate_limited(e) or attempt == self.MAX_RETRIES - 1:
+                    raise
+                time.sleep(2**attempt)
+
+    def fetch_all(self, list_method, **params):
+        """
+        Call one of the client's list_* methods and return all of its results,
+        retried like `fetch`.
+        """
+        return self.fetch(lambda **kwargs: list(list_method(**kwargs)), **params)
@@ -9,18 +9,36 @@ from Polygon.io's Flat Files service via their S3 interface.
 
 import os
 import logging
+import time
 import boto3
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Dict, Optional, Union, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from datetime import datetime, date
-import gzip
+import shutil
 import pandas as pd
+from pyarrow import csv as pacsv
 from dotenv import load_dotenv
 
+try:
+    # python-isal's igzip is a faster drop-in replacement for gzip
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Chunk size used when streaming decompressed data to disk (matches
+# gzip.READ_BUFFER_SIZE)
+COPY_BUFFER_SIZE = 128 * 1024
+
+# Bytes of CSV handed to each pyarrow parsing thread
+CSV_BLOCK_SIZE = 8 << 20
+
 
 class PolygonS3Connector:
     """
@@ -62,13 +80,40 @@ class PolygonS3Connector:
         },
     }
 
-    def __init__(self, env_file: Optional[str] = None):
+    # Asset classes with flat files for weekends as well as weekdays
+    WEEKEND_ASSET_CLASSES = ("forex", "crypto")
+
+    # Default number of concurrent downloads
+    MAX_WORKERS = 16
+
+    # Minimum size of the S3 connection pool. Large files are fetched with
+    # several ranged GETs at once, so workers need more than one connection each
+    MAX_POOL_CONNECTIONS = 64
+
+    # Attempts at streaming a gzipped file when decompressing on the fly. A
+    # broken stream restarts the download from the beginning
+    STREAM_ATTEMPTS = 3
+
+    # Multipart settings for downloading large (often >1GB) flat files. Only
+    # used when files are kept compressed; decompressed downloads are
+    # streamed with a single GET
+    TRANSFER_CONFIG = TransferConfig(
+        multipart_threshold=64 * 1024 * 1024,
+        multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=10,
+        io_chunksize=256 * 1024,
+        max_io_queue=1000,
+    )
+
+    def __init__(self, env_file: Optional[str] = None, max_workers: int = MAX_WORKERS):
         """
         Initialize the Polygon S3 connector.
 
         Args:
             env_file: Optional path to .env file with credentials. If None,
                      credentials are loaded from environment variables.
+            max_workers: Default number of concurrent downloads. The S3 connection
+                     pool is at least this large so worker threads don't queue on it.
         """
         # Load environment variables if env_file is provided
         if env_file:
@@ -89,12 +134,19 @@ class PolygonS3Connector:
                 "POLYGON_SECRET_ACCESS_KEY environment variables or provide an env_file."
             )
 
-        # Initialize S3 client
+        # Initialize S3 client (low-level clients are thread-safe, so one client
+        # is shared by all download workers)
+        self.max_workers = max_workers
         self.s3_client = boto3.client(
             "s3",
             aws_access_key_id=self.access_key,
             aws_secret_access_key=self.secret_key,
             endpoint_url=self.endpoint_url,
+            config=Config(
+                max_pool_connections=max(self.MAX_POOL_CONNECTIONS, max_workers),
+                retries={"max_attempts": 10, "mode": "adaptive"},
+                tcp_keepalive=True,
+            ),
         )
 
         logger.info(
@@ -109,49 +161,61 @@ class PolygonS3Connector:
             Dictionary of available data categories and their prefixes.
         """
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name, Delimiter="/"
-            )
-
-            prefixes = [
-                prefix.get("Prefix") for prefix in response.get("CommonPrefixes", [])
-            ]
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            prefixes = []
+            for page in paginator.paginate(Bucket=self.bucket_name, Delimiter="/"):
+                prefixes.extend(
+                    prefix.get("Prefix") for prefix in page.get("CommonPrefixes", [])
+                )
             return {"available_prefixes": prefixes}
 
         except ClientError as e:
             logger.error(f"Error listing available data: {e}")
             return {"error": str(e)}
 
-    def list_files(self, prefix: str) -> List[Dict]:
+    def iter_files(self, prefix: str) -> Iterator[Dict]:
         """
-        List files in a specific prefix/directory.
+        Lazily iterate over files in a specific prefix/directory.
+
+        Pages of up to 1000 keys are fetched on demand, so callers can start
+        working on the first files before the whole prefix has been listed.
 
         Args:
             prefix: S3 prefix/directory to list
 
-        Returns:
-            List of dictionaries containing file metadata
+        Yields:
+            Dictionaries containing file metadata
         """
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name, Prefix=prefix
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            pages = paginator.paginate(
+                Bucket=self.bucket_name,
+                Prefix=prefix,
+                PaginationConfig={"PageSize": 1000},
             )
 
-            files = []
-            for item in response.get("Contents", []):
-                files.append(
-                    {
+            for page in pages:
+                for item in page.get("Contents", []):
+                    yield {
                         "key": item.get("Key"),
                         "size": item.get("Size"),
                         "last_modified": item.get("LastModified"),
                     }
-                )
-
-            return files
 
         except ClientError as e:
             logger.error(f"Error listing files for prefix {prefix}: {e}")
-            return []
+
+    def list_files(self, prefix: str) -> List[Dict]:
+        """
+        List files in a specific prefix/directory.
+
+        Args:
+            prefix: S3 prefix/directory to list
+
+        Returns:
+            List of dictionaries containing file metadata
+        """
+        return list(self.iter_files(prefix))
 
     def list_data_by_category(
         self,
@@ -215,47 +279,77 @@ class PolygonS3Connector:
 
         try:
             logger.info(f"Downloading {s3_key} to {local_path}")
-            self.s3_client.download_file(
-                Bucket=self.bucket_name, Key=s3_key, Filename=str(local_path)
-            )
 
-            # Decompress if file is gzipped and decompress is True
+            # Decompress gzipped files while streaming them from S3, so the
+            # compressed copy is never written to disk
             if decompress and s3_key.endswith(".gz"):
                 decompressed_path = local_path.with_suffix("")
-                with gzip.open(local_path, "rb") as f_in:
-                    with open(decompressed_path, "wb") as f_out:
-                        f_out.write(f_in.read())
+                partial_path = decompressed_path.with_name(
+                    decompressed_path.name + ".part"
+                )
+
+                try:
+                    self._stream_decompressed(s3_key, partial_path)
+                except BaseException:
+                    partial_path.unlink(missing_ok=True)
+                    raise
 
-                # Remove the compressed file
-                local_path.unlink()
+                # Only expose the file under its final name once it is complete
+                partial_path.replace(decompressed_path)
                 return decompressed_path
 
+            self.s3_client.download_file(
+                Bucket=self.bucket_name,
+                Key=s3_key,
+                Filename=str(local_path),
+                Config=self.TRANSFER_CONFIG,
+            )
+
             return local_path
 
         except ClientError as e:
             logger.error(f"Error downloading file {s3_key}: {e}")
             raise
 
-    def download_data(
-        self,
-        asset_class: str,
-        data_type: str,
-        date_str: str,
-        local_dir: Union[str, Path],
-        decompress: bool = True,
-    ) -> List[Path]:
+    def _stream_decompressed(self, s3_key: str, partial_path: Path) -> None:
         """
-        Download data for a specific date.
+        Stream a gzipped object from S3 and write it decompressed to
+        partial_path.
+
+        Unlike the managed transfer, a plain GET isn't retried once its body
+        is being read, so a connection dropped partway through restarts the
+        download, up to STREAM_ATTEMPTS times with exponential backoff.
+        """
+        for attempt in range(self.STREAM_ATTEMPTS):
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name, Key=s3_key
+                )
+                # opening for writing truncates what a failed attempt left
+                with gzip.open(response["Body"], "rb") as f_in:
+                    with open(partial_path, "wb") as f_out:
+                        shutil.copyfileobj(f_in, f_out, length=COPY_BUFFER_SIZE)
+                return
+            except (BotoCoreError, OSError) as e:
+                if attempt == self.STREAM_ATTEMPTS - 1:
+                    raise
+                logger.warning(
+                    f"Streaming {s3_key} failed ({e}), retrying "
+                    f"({attempt + 1}/{self.STREAM_ATTEMPTS - 1})"
+                )
+                time.sleep(2**attempt)
+
+    def _date_prefix(self, asset_class: str, data_type: str, date_str: str) -> str:
+        """
+        Build the S3 prefix holding the files for a specific date.
 
         Args:
             asset_class: Asset class (stocks, options, forex, crypto, indices)
             data_type: Type of data (trades, quotes, day_aggs, minute_aggs, values)
             date_str: Date string in YYYY-MM-DD format
-            local_dir: Local directory to save files
-            decompress: Whether to decompress .gz files automatically
 
         Returns:
-            List of paths to downloaded files
+            S3 prefix for the given date
         """
         if asset_class not in self.DATA_CATEGORIES:
             raise ValueError(
@@ -276,36 +370,154 @@ class PolygonS3Connector:
 
         # Construct the prefix
         base_prefix = self.DATA_CATEGORIES[asset_class][data_type]
-        prefix = f"{base_prefix}/{dt.year}/{dt.month:02d}/{date_str.replace('-', '')}"
+        return f"{base_prefix}/{dt.year}/{dt.month:02d}/{date_str}"
 
-        # List files matching the prefix
-        files = self.list_files(prefix)
+    def _local_copy(
+        self, file_info: Dict, local_dir: Path, decompress: bool
+    ) -> Optional[Path]:
+        """
+        Find an up-to-date local copy of a listed file.
 
-        if not files:
-            logger.warning(f"No files found for {prefix}")
-            return []
+        A copy is up to date when it is non-empty and was written after the
+        object was last modified in S3. Compressed copies must also match the
+        object's size.
 
-        # Download each file
-        local_dir = Path(local_dir)
-        downloaded_files = []
+        Returns:
+            Path to the local copy, or None if the file needs downloading
+        """
+        s3_key = file_info["key"]
+        local_path = local_dir / Path(s3_key).name
+        decompressed = decompress and s3_key.endswith(".gz")
+        if decompressed:
+            local_path = local_path.with_suffix("")
+
+        if not local_path.exists():
+            return None
+
+        stat = local_path.stat()
+        if stat.st_size == 0:
+            return None
+        if not decompressed and stat.st_size != file_info.get("size"):
+            return None
+        last_modified = file_info.get("last_modified")
+        if last_modified and stat.st_mtime < last_modified.timestamp():
+            return None
+
+        return local_path
+
+    def _submit_downloads(
+        self,
+        executor: ThreadPoolExecutor,
+        files: Iterable[Dict],
+        local_dir: Path,
+        decompress: bool,
+        overwrite: bool,
+    ) -> Dict[Future, str]:
+        """
+        Submit a download task for each file to the executor.
+
+        Files with an up-to-date local copy are not downloaded again unless
+        overwrite is set; their future resolves to the existing path.
 
+        Returns:
+            Dictionary mapping each pending future to its S3 key
+        """
+        futures = {}
         for file_info in files:
             s3_key = file_info["key"]
-            filename = Path(s3_key).name
-            local_path = local_dir / filename
+            local_copy = (
+                None
+                if overwrite
+                else self._local_copy(file_info, local_dir, decompress)
+            )
+
+            if local_copy is not None:
+                logger.info(f"Skipping {s3_key}, already downloaded to {local_copy}")
+                future = Future()
+                future.set_result(local_copy)
+            else:
+                future = executor.submit(
+                    self.download_file,
+                    s3_key,
+                    local_dir / Path(s3_key).name,
+                    decompress,
+                )
+
+            futures[future] = s3_key
 
+        return futures
+
+    def _collect_downloads(self, futures: Dict[Future, str]) -> List[Path]:
+        """
+        Wait for submitted downloads and gather the successful ones.
+
+        Returns:
+            List of paths to downloaded files, in submission order
+        """
+        downloaded = {}
+        for future in as_completed(futures):
+            s3_key = futures[future]
             try:
-                downloaded_path = self.download_file(s3_key, local_path, decompress)
-                downloaded_files.append(downloaded_path)
-            except ClientError as e:
+                downloaded[s3_key] = future.result()
+            except (ClientError, BotoCoreError, OSError) as e:
                 logger.error(f"Failed to download {s3_key}: {e}")
 
-        return downloaded_files
+        return [downloaded[key] for key in futures.values() if key in downloaded]
+
+    def download_data(
+        self,
+        asset_class: str,
+        data_type: str,
+        date_str: str,
+        local_dir: Union[str, Path],
+        decompress: bool = True,
+        max_workers: Optional[int] = None,
+        overwrite: bool = False,
+    ) -> List[Path]:
+        """
+        Download data for a specific date.
+
+        Args:
+            asset_class: Asset class (stocks, options, forex, crypto, indices)
+            data_type: Type of data (trades, quotes, day_aggs, minute_aggs, values)
+            date_str: Date string in YYYY-MM-DD format
+            local_dir: Local directory to save files
+            decompress: Whether to decompress .gz files automatically
+            max_workers: Number of concurrent downloads (defaults to the
+                     connector's max_workers)
+            overwrite: Download files again even if an up-to-date local copy
+                     exists
+
+        Returns:
+            List of paths to downloaded files
+        """
+        prefix = self._date_prefix(asset_class, data_type, date_str)
+
+        # Download files concurrently as they are listed
+        with ThreadPoolExecutor(
+            max_workers=max_workers or self.max_workers
+        ) as executor:
+            futures = self._submit_downloads(
+                executor,
+                self.iter_files(prefix),
+                Path(local_dir),
+                decompress,
+                overwrite,
+            )
+
+            if not futures:
+                logger.warning(f"No files found for {prefix}")
+                return []
+
+            return self._collect_downloads(futures)
 
     def load_to_dataframe(self, file_path: Union[str, Path]) -> pd.DataFrame:
         """
         Load a CSV file into a Pandas DataFrame.
 
+        The file is parsed with pyarrow's multi-threaded CSV reader and then
+        handed over to pandas.
+
         Args:
             file_path: Path to the CSV file
 
@@ -317,11 +529,16 @@ class PolygonS3Connector:
         if not file_path.exists():
             raise FileNotFoundError(f"File not found: {file_path}")
 
+        read_options = pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE, use_threads=True)
+
         # Check if file is gzipped
         if file_path.suffix == ".gz":
-            return pd.read_csv(file_path, compression="gzip")
+            with gzip.open(file_path, "rb") as f_in:
+                table = pacsv.read_csv(f_in, read_options=read_options)
         else:
-            return pd.read_csv(file_path)
+            table = pacsv.read_csv(file_path, read_options=read_options)
+
+        return table.to_pandas(split_blocks=True, self_destruct=True)
 
     def download_date_range(
         self,
@@ -331,10 +548,16 @@ class PolygonS3Connector:
         end_date: Union[str, date],
         local_dir: Union[str, Path],
         decompress: bool = True,
+        max_workers: Optional[int] = None,
+        overwrite: bool = False,
+        freq: Optional[str] = None,
     ) -> Dict[str, List[Path]]:
         """
         Download data for a range of dates.
 
+        Files for all dates are downloaded through a single thread pool, so
+        downloads for early dates run while later dates are still being listed.
+
         Args:
             asset_class: Asset class (stocks, options, forex, crypto, indices)
             data_type: Type of data (trades, quotes, day_aggs, minute_aggs, values)
@@ -342,6 +565,12 @@ class PolygonS3Connector:
             end_date: End date (YYYY-MM-DD string or date object)
             local_dir: Local directory to save files
             decompress: Whether to decompress .gz files automatically
+            max_workers: Number of concurrent downloads (defaults to the
+                     connector's max_workers)
+            overwrite: Download files again even if an up-to-date local copy
+                     exists
+            freq: Pandas frequency of the dates to fetch. Defaults to business
+                     days ("B"), or every day ("D") for forex and crypto
 
         Returns:
             Dictionary mapping dates to lists of downloaded files
@@ -355,26 +584,32 @@ class PolygonS3Connector:
         if start_date > end_date:
             raise ValueError("start_date must be before or equal to end_date")
 
-        # Generate date range
-        current_date = start_date
-        all_files = {}
-
-        while current_date <= end_date:
-            date_str = current_date.strftime("%Y-%m-%d")
-            files = self.download_data(
-                asset_class=asset_class,
-                data_type=data_type,
-                date_str=date_str,
-                local_dir=local_dir,
-                decompress=decompress,
-            )
+        # Generate date range, skipping weekends for markets that are closed
+        if freq is None:
+            freq = "D" if asset_class in self.WEEKEND_ASSET_CLASSES else "B"
+        dates = pd.date_range(start_date, end_date, freq=freq)
+
+        local_dir = Path(local_dir)
+        pending = {}
+
+        with ThreadPoolExecutor(
+            max_workers=max_workers or self.max_workers
+        ) as executor:
+            for date_str in dates.strftime("%Y-%m-%d"):
+                prefix = self._date_prefix(asset_class, data_type, date_str)
+                futures = self._submit_downloads(
+                    executor, self.iter_files(prefix), local_dir, decompress, overwrite
+                )
 
-            all_files[date_str] = files
+                if not futures:
+                    logger.warning(f"No files found for {prefix}")
 
-            # Move to next day
-            current_date = date.fromordinal(current_date.toordinal() + 1)
+                pending[date_str] = futures
 
-        return all_files
+            return {
+                date_str: self._collect_downloads(futures)
+                for date_str, futures in pending.items()
+            }
 
 
 if __name__ == "__main__":
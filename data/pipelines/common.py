@@ -0,0 +1,140 @@
+"""Helpers shared by the Polygon reference data pipelines."""
+
+import logging
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+# Number of keys (tickers, FIGIs, ...) fetched concurrently
+FETCH_WORKERS = 16
+
+
+def fetch_concurrently(connector, method, keys, desc, params_for, paginated=True):
+    """
+    Call the client `method` once per key on a thread pool, with the
+    parameters returned by `params_for(key)`. Paginated methods have all of
+    their pages fetched.
+
+    Requests are throttled by the connector's rate limiter, so the thread
+    pool only hides network latency. Yields (key, result) pairs as the
+    requests complete; keys whose request failed are logged and skipped.
+    """
+    fetch = connector.fetch_all if paginated else connector.fetch
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch, method, **params_for(key)): key for key in keys
+        }
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            key = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Error fetching {key}: {e}")
+                continue
+            yield key, result
+
+
+def ensure_dt(dates):
+    """Parse a column of YYYY-MM-DD dates, unless it already holds datetimes."""
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    return pd.to_datetime(dates, format="%Y-%m-%d", cache=True)
+
+
+def drop_duplicate_keys(df, key_columns, keep="first"):
+    """
+    Drop the rows of `df` repeating the values of `key_columns` in an earlier
+    row (or a later one, with keep="last"). The key columns are hashed into a
+    single uint64 per row first, so only one column has to be compared.
+    """
+    key_hash = pd.util.hash_pandas_object(df[key_columns], index=False)
+    return df.loc[~key_hash.duplicated(keep=keep).to_numpy()]
+
+
+def write_parquet(df, path, dictionary_columns):
+    """
+    Write a pipeline's dataframe to parquet with zstd, dictionary encoding
+    `dictionary_columns`, the string columns with few distinct values.
+    """
+    pq.write_table(
+        pa.Table.from_pandas(df, preserve_index=False),
+        path,
+        compression="zstd",
+        compression_level=3,
+        use_dictionary=dictionary_columns,
+    )
+
+
+def load_last_checked(path, key):
+    """
+    Load when each key (ticker, FIGI, ...) was last fetched, as a dict of key
+    to datetime, from a file saved by `write_last_checked`. Empty if nothing
+    was recorded yet.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        table = pq.read_table(path)
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Error loading {path}: {e}")
+        return {}
+    return dict(
+        zip(table.column(key).to_pylist(), table.column("last_checked").to_pylist())
+    )
+
+
+def write_last_checked(last_checked, path, key):
+    """Save a mapping of key to last fetch time, stored under the `key` column."""
+    pq.write_table(
+        pa.table(
+            {
+                key: pa.array(list(last_checked.keys()), pa.string()),
+                "last_checked": pa.array(
+                    list(last_checked.values()), pa.timestamp("us")
+                ),
+            }
+        ),
+        path,
+        compression="zstd",
+    )
+
+
+def is_stale(key, checked, now, ttl):
+    """
+    Whether `key`, last fetched at `checked` (None if never), is due to be
+    fetched again.
+
+    The ttl of each key is scaled by a factor between 0.5 and 1 derived from
+    the key, so keys fetched in the same run go stale on different days
+    rather than all at once, and none is left unchecked for longer than ttl.
+    """
+    if checked is None:
+        return True
+    jitter = 0.5 + zlib.crc32(str(key).encode()) / 2**33
+    return checked < now - ttl * jitter
+
+
+def stale_from_dates(keys, last_checked, from_date, now, ttl):
+    """
+    Map each key that is due to be fetched again (see `is_stale`) to the
+    earliest date (YYYY-MM-DD) to fetch it from.
+
+    That is `from_date`, or a week before the key's own last fetch if that's
+    earlier, so that nothing is missed while the key was skipped.
+    """
+    from_dates = {}
+    for key in keys:
+        checked = last_checked.get(key)
+        if checked is None:
+            from_dates[key] = from_date
+        elif is_stale(key, checked, now, ttl):
+            checked_from = (checked - timedelta(days=7)).strftime("%Y-%m-%d")
+            from_dates[key] = min(from_date, checked_from)
+    return from_dates
@@ -1,28 +1,93 @@
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from glob import glob
 from os import getenv
 import os
 from tqdm import tqdm
 
+# One row per trading day with the sorted list of tickers that traded on it
+SCHEMA = pa.schema([("date", pa.string()), ("tickers", pa.list_(pa.string()))])
+
+
+def load_daily_tickers(path):
+    """
+    Load the per-date ticker lists from a memory-mapped parquet file.
+
+    Older files kept the date in the pandas index and packed the tickers into
+    a comma-joined string; those are converted to the current schema.
+    """
+    table = pq.read_table(path, memory_map=True)
+    if "date" in table.column_names:
+        return table
+
+    legacy = table.to_pandas()
+    return pa.table(
+        {
+            "date": pa.array(legacy.index.astype(str), pa.string()),
+            "tickers": pc.split_pattern(pa.array(legacy["tickers"], pa.string()), ","),
+        },
+        schema=SCHEMA,
+    )
+
+
+def _file_date(file_name):
+    return os.path.split(file_name)[-1].split(".")[0]
+
+
+def _uticks(file_name):
+    """
+    Return the date of a daily aggregates file and the sorted unique tickers
+    in it. Runs in a worker process.
+    """
+    tickers = pq.read_table(file_name, columns=["ticker"], memory_map=True)
+    uticks = pc.unique(pc.drop_null(tickers.column("ticker")))
+    uticks = pc.take(uticks, pc.sort_indices(uticks)).to_pylist()
+    return _file_date(file_name), uticks
+
+
 if __name__ == "__main__":
     all_tickers_path = os.path.join(
         getenv("EQUITY_META_DATA"), "all_daily_tickers.gzip"
     )
 
-    if all_tickers_path in glob(os.path.join(getenv("EQUITY_META_DATA"), "*")):
-        all_daily_tickers = pd.read_parquet(all_tickers_path)
+    if os.path.exists(all_tickers_path):
+        all_daily_tickers = load_daily_tickers(all_tickers_path)
     else:
-        all_daily_tickers = pd.DataFrame(columns=["tickers"])
+        all_daily_tickers = SCHEMA.empty_table()
+    existing_dates = set(all_daily_tickers.column("date").to_pylist())
 
     all_daily_files = glob(os.path.join(getenv("EQUITY_DAILY_DATA_PATH"), "*"))
+    missing_files = [
+        file_name
+        for file_name in all_daily_files
+        if _file_date(file_name) not in existing_dates
+    ]
+
+    # reading and deduplicating each file is CPU bound, so spread the files
+    # over all cores
+    new_dates = []
+    new_tickers = []
+    with ProcessPoolExecutor() as executor:
+        for date, uticks in tqdm(
+            executor.map(_uticks, missing_files, chunksize=8),
+            total=len(missing_files),
+        ):
+            new_dates.append(date)
+            new_tickers.append(uticks)
 
-    for file_name in tqdm(all_daily_files):
-        date = os.path.split(file_name)[-1].split(".")[0]
-        if date not in all_daily_tickers.index:
-            contents = pd.read_parquet(file_name)
-            uticks = (
-                contents["ticker"].drop_duplicates().sort_values().dropna().tolist()
-            )
-            uticks_str = ",".join(uticks)
-            all_daily_tickers.loc[date] = [uticks_str]
-    all_daily_tickers.to_parquet(all_tickers_path)
+    # only rewrite the file when new dates were added; write to a temporary
+    # file first since the existing one is still memory-mapped
+    if new_dates:
+        additions = pa.table({"date": new_dates, "tickers": new_tickers}, schema=SCHEMA)
+        all_daily_tickers = pa.concat_tables([all_daily_tickers, additions])
+        tmp_path = all_tickers_path + ".tmp"
+        pq.write_table(
+            all_daily_tickers,
+            tmp_path,
+            compression="zstd",
+            compression_level=3,
+            use_dictionary=True,
+        )
+        os.replace(tmp_path, all_tickers_path)
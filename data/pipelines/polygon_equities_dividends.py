@@ -1,139 +1,196 @@
-from data.connectors.polygon_connector import PolygonConnector
+from data.connectors import get_connector
+from data.pipelines.common import fetch_concurrently
 import pandas as pd
-from tqdm import tqdm
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import os
+import shutil
+import uuid
 from datetime import datetime, timedelta
 import logging
 
+# Dividend history is stored as a parquet dataset with one hive partition
+# (year=YYYY) per ex-dividend year
+SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("cash_amount", pa.float64()),
+        ("currency", pa.string()),
+        ("declaration_date", pa.string()),
+        ("dividend_type", pa.string()),
+        ("ex_dividend_date", pa.timestamp("ns")),
+        ("frequency", pa.int64()),
+        ("pay_date", pa.string()),
+        ("record_date", pa.string()),
+        ("ticker", pa.string()),
+    ]
+)
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int32())]), flavor="hive")
+KEY_COLUMNS = ["ticker", "ex_dividend_date", "cash_amount"]
+
+
+def fetch_dividends(connector, tickers, desc, **params):
+    """Fetch the dividends of every ticker concurrently, as a DataFrame."""
+    # collect one list per column rather than one dict per dividend
+    columns = {name: [] for name in SCHEMA.names}
+    for _, dividends in fetch_concurrently(
+        connector,
+        connector.client.list_dividends,
+        tickers,
+        desc,
+        lambda ticker: dict(
+            ticker=ticker,
+            sort="ex_dividend_date",
+            order="asc",
+            limit=1000,  # Maximum allowed by API
+            **params,
+        ),
+    ):
+        for div in dividends:
+            if div:
+                for name, values in columns.items():
+                    values.append(getattr(div, name, None))
+
+    return pd.DataFrame(columns)
+
+
+def to_table(records_df):
+    """Conform a frame of dividend records to SCHEMA."""
+    records_df = records_df.reindex(columns=SCHEMA.names)
+    records_df["ex_dividend_date"] = pd.to_datetime(records_df["ex_dividend_date"])
+    return pa.Table.from_pandas(records_df, schema=SCHEMA, preserve_index=False)
+
+
+def append_dividends(table, output_dir):
+    """
+    Add dividend records to the dataset, partitioned by ex-dividend year.
+
+    Every call writes new files, so existing partitions are never rewritten.
+    """
+    year = pc.cast(pc.year(table["ex_dividend_date"]), pa.int32())
+    ds.write_dataset(
+        table.append_column("year", year),
+        output_dir,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=ds.ParquetFileFormat().make_write_options(
+            compression="zstd", compression_level=3, use_dictionary=True
+        ),
+        max_rows_per_group=256_000,
+    )
+
+
+def replace_dataset(table, output_dir):
+    """
+    Replace the dataset with `table`, building it next to `output_dir` and
+    moving it into place only once complete, so that a failed build never
+    leaves a partial history behind.
+    """
+    staging_dir = output_dir + ".part"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    try:
+        append_dividends(table, staging_dir)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.replace(staging_dir, output_dir)
+
 
 def update_dividend_history():
-    connector = PolygonConnector()
-    output_path = os.path.join(os.getenv("EQUITY_META_DATA"), "dividends.gzip")
+    logger = logging.getLogger(__name__)
+    connector = get_connector()
+    output_dir = os.path.join(os.getenv("EQUITY_META_DATA"), "dividends")
+    legacy_path = os.path.join(os.getenv("EQUITY_META_DATA"), "dividends.gzip")
 
     # Load all tickers
     all_tickers = pd.read_csv(
-        os.path.join(os.getenv("EQUITY_META_DATA"), "all_ticker_meta.csv")
+        os.path.join(os.getenv("EQUITY_META_DATA"), "all_ticker_meta.csv"),
+        usecols=["ticker"],
+        engine="pyarrow",
     )
     all_tickers_list = all_tickers["ticker"].drop_duplicates().tolist()
 
+    # Move history saved as a single file into the partitioned dataset
+    if not os.path.exists(output_dir) and os.path.exists(legacy_path):
+        try:
+            replace_dataset(to_table(pd.read_parquet(legacy_path)), output_dir)
+        except Exception as e:
+            # without a dataset the full history is imported again below
+            logger.error(f"Error migrating {legacy_path}: {e}")
+
     # Check if we have existing dividend data
     existing_dividends = None
-    if os.path.exists(output_path):
+    latest_ex_div_date = None
+    if os.path.exists(output_dir):
         try:
-            existing_dividends = pd.read_parquet(output_path)
+            existing_dividends = ds.dataset(
+                output_dir, format="parquet", partitioning=PARTITIONING
+            )
+            # Find the latest ex_dividend_date we have in our data
+            latest_ex_div_date = pc.max(
+                existing_dividends.to_table(columns=["ex_dividend_date"]).column(0)
+            ).as_py()
 
         except Exception as e:
-            existing_dividends = None
+            # importing everything again would duplicate whatever is stored
+            logger.error(f"Error loading dividend history from {output_dir}: {e}")
+            raise
 
     # Determine what to update
-    if existing_dividends is not None and not existing_dividends.empty:
-        # Find the latest ex_dividend_date we have in our data
-        latest_ex_div_date = pd.to_datetime(
-            existing_dividends["ex_dividend_date"]
-        ).max()
-
+    if latest_ex_div_date is not None:
         # Use a buffer of 7 days to ensure we don't miss any dividends due to data delays
         from_date = (latest_ex_div_date - timedelta(days=7)).strftime("%Y-%m-%d")
 
         # Process all tickers but only fetch newer dividend records
-        new_dividend_records = []
-
-        # Split tickers into batches to avoid rate limiting
-        batch_size = 100
-        ticker_batches = [
-            all_tickers_list[i : i + batch_size]
-            for i in range(0, len(all_tickers_list), batch_size)
-        ]
-
-        for batch in tqdm(ticker_batches, desc="Processing ticker batches"):
-            for ticker in tqdm(batch, desc="Updating dividend history", leave=False):
-                try:
-                    # Use the ex_dividend_date_gte parameter to get dividends after our latest date
-                    # Sort by ex_dividend_date in ascending order to get oldest first
-                    for div in connector.client.list_dividends(
-                        ticker=ticker,
-                        ex_dividend_date_gte=from_date,
-                        sort="ex_dividend_date",
-                        order="asc",
-                        limit=1000,  # Maximum allowed by API
-                    ):
-                        if div:
-                            new_dividend_records.append(div.__dict__)
-                except Exception as e:
-                    print(e)
-
-            # Add a small delay between batches to avoid rate limiting
-            time.sleep(1)
-
-        # Convert new records to DataFrame
-        if new_dividend_records:
-            new_records_df = pd.DataFrame(new_dividend_records)
-
-            # Drop any duplicate records before merging
-            # First ensure the ex_dividend_date is in datetime format for comparison
-            if "ex_dividend_date" in new_records_df.columns:
-                new_records_df["ex_dividend_date"] = pd.to_datetime(
-                    new_records_df["ex_dividend_date"]
-                )
-
-            # Do the same for the existing data
-            existing_dividends["ex_dividend_date"] = pd.to_datetime(
-                existing_dividends["ex_dividend_date"]
-            )
-
-            # Merge with existing data
-            combined_df = pd.concat([existing_dividends, new_records_df])
-
-            # Remove duplicates based on ticker and ex_dividend_date
-            combined_df = combined_df.drop_duplicates(
-                subset=["ticker", "ex_dividend_date", "cash_amount"]
-            )
-
-            # Save the updated dataset
-            combined_df.to_parquet(path=output_path, index=False)
-
-            return combined_df
-        else:
-            return existing_dividends
+        # Use the ex_dividend_date_gte parameter to get dividends after our latest date
+        new_records_df = fetch_dividends(
+            connector,
+            all_tickers_list,
+            "Updating dividend history",
+            ex_dividend_date_gte=from_date,
+        )
+
+        if new_records_df.empty:
+            return new_records_df
+
+        new_records_df = new_records_df.drop_duplicates(subset=KEY_COLUMNS)
+
+        # Only records inside the buffer window can already be stored, so
+        # drop the new records matching one of those
+        stored = existing_dividends.to_table(
+            columns=KEY_COLUMNS,
+            filter=ds.field("ex_dividend_date")
+            >= datetime.strptime(from_date, "%Y-%m-%d"),
+        )
+        new_table = to_table(new_records_df).join(
+            stored, keys=KEY_COLUMNS, join_type="left anti"
+        )
+
+        # Save only the new records
+        if new_table.num_rows:
+            append_dividends(new_table, output_dir)
+
+        return new_table.to_pandas()
     else:
         # Initial import - we'll fetch all historical dividends
-        dividend_history = []
-
-        # Split tickers into batches
-        batch_size = 100
-        ticker_batches = [
-            all_tickers_list[i : i + batch_size]
-            for i in range(0, len(all_tickers_list), batch_size)
-        ]
-
-        for batch in tqdm(ticker_batches, desc="Processing ticker batches"):
-            for ticker in tqdm(batch, desc="Getting all dividend history", leave=False):
-                try:
-                    # We need to fetch all dividend history for initial import
-                    for div in connector.client.list_dividends(
-                        ticker=ticker,
-                        limit=1000,  # Maximum allowed by API
-                        sort="ex_dividend_date",
-                        order="asc",
-                    ):
-                        if div:
-                            dividend_history.append(div.__dict__)
-                except Exception as e:
-                    print(e)
-
-            # Add a small delay between batches to avoid rate limiting
-            time.sleep(1)
-
-        # Create DataFrame and save
-        dividend_history_df = pd.DataFrame(dividend_history)
+        dividend_history_df = fetch_dividends(
+            connector, all_tickers_list, "Getting all dividend history"
+        )
 
+        # Save the new DataFrame, replacing an empty dataset if there is one
         if not dividend_history_df.empty:
-            dividend_history_df.to_parquet(path=output_path, index=False)
+            replace_dataset(
+                to_table(dividend_history_df.drop_duplicates(subset=KEY_COLUMNS)),
+                output_dir,
+            )
 
         return dividend_history_df
 
 
 if __name__ == "__main__":
-    import time
-
     update_dividend_history()
@@ -1,20 +1,31 @@
-from data.connectors.polygon_connector import PolygonConnector
+from data.connectors import get_connector
+from data.pipelines.common import fetch_concurrently
 import pandas as pd
-from tqdm import tqdm
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
-import time
-from dataclasses import asdict
+from dataclasses import asdict, fields, is_dataclass
+from functools import lru_cache
+from polygon.rest.models import StockFinancial
+
+FINANCIAL_FIELDS = [field.name for field in fields(StockFinancial)]
+
+
+@lru_cache(maxsize=None)
+def load_ticker_list(path):
+    """Unique tickers in the ticker metadata csv, loaded once per process."""
+    tickers = pd.read_csv(path, usecols=["ticker"], engine="pyarrow")
+    return tuple(tickers["ticker"].drop_duplicates().dropna().tolist())
 
 
 def update_fundamental_history():
-    connector = PolygonConnector()
+    connector = get_connector()
     output_path = os.path.join(os.getenv("EQUITY_META_DATA"), "fundamentals.gzip")
 
     # Load tickers
-    tickers = pd.read_csv(
+    ticker_list = load_ticker_list(
         os.path.join(os.getenv("EQUITY_META_DATA"), "all_ticker_meta.csv")
     )
-    ticker_list = tickers["ticker"].drop_duplicates().dropna().tolist()
 
     # Load existing fundamentals if present
     existing_fundamentals = None
@@ -24,26 +35,37 @@ def update_fundamental_history():
         except Exception:
             existing_fundamentals = None
 
-    processed = set()
+    processed = frozenset()
     if (
         existing_fundamentals is not None
         and not existing_fundamentals.empty
         and "ticker" in existing_fundamentals.columns
     ):
-        processed = set(existing_fundamentals["ticker"].dropna().unique())
+        processed = frozenset(existing_fundamentals["ticker"].dropna().unique())
 
-    fundamental_records = []
-    for ticker in tqdm(ticker_list, desc="Fetching fundamentals"):
-        if ticker in processed:
-            continue
-        try:
-            for fin in connector.client.vx.list_stock_financials(ticker=ticker):
-                fundamental_records.append({"ticker": ticker, **asdict(fin)})
-        except Exception as e:
-            print(e)
-        time.sleep(0.2)
+    # Only fetch tickers we don't have fundamentals for yet
+    todo = [ticker for ticker in ticker_list if ticker not in processed]
+
+    # collect one list per column rather than one dict per filing
+    fundamental_records = {name: [] for name in ["ticker", *FINANCIAL_FIELDS]}
+
+    for ticker, financials in fetch_concurrently(
+        connector,
+        connector.client.vx.list_stock_financials,
+        todo,
+        "Fetching fundamentals",
+        lambda ticker: dict(ticker=ticker),
+    ):
+        for fin in financials:
+            fundamental_records["ticker"].append(ticker)
+            for name in FINANCIAL_FIELDS:
+                value = getattr(fin, name, None)
+                # nested statements are stored as plain dicts
+                if is_dataclass(value):
+                    value = asdict(value)
+                fundamental_records[name].append(value)
 
-    if fundamental_records:
+    if fundamental_records["ticker"]:
         new_df = pd.DataFrame(fundamental_records)
         if existing_fundamentals is not None:
             combined_df = pd.concat([existing_fundamentals, new_df], ignore_index=True)
@@ -52,7 +74,16 @@ def update_fundamental_history():
             )
         else:
             combined_df = new_df
-        combined_df.to_parquet(path=output_path, index=False)
+        # zstd with dictionary-encoded strings keeps the repeated ticker and
+        # period values small
+        pq.write_table(
+            pa.Table.from_pandas(combined_df, preserve_index=False),
+            output_path,
+            compression="zstd",
+            compression_level=3,
+            use_dictionary=True,
+            row_group_size=256_000,
+        )
         return combined_df
     else:
         return existing_fundamentals
@@ -1,17 +1,98 @@
-from data.connectors.polygon_connector import PolygonConnector
+from data.connectors import get_connector
+from data.pipelines.common import write_parquet
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from tqdm import tqdm
 import os
 from datetime import datetime, timedelta
 import logging
-import time
 import requests
+from urllib.parse import parse_qs, urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared session so that paginated requests reuse one keep-alive connection
+# instead of paying a TCP and TLS handshake per page. Throttled (429)
+# responses are retried after the delay given in their Retry-After header,
+# so pages are requested back to back without a fixed pause between them.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]
+        ),
+    ),
+)
+_SESSION.headers.update({"Accept-Encoding": "gzip"})
+
+IPOS_URL = "https://api.polygon.io/vX/reference/ipos"
+# The initial import scans one year of listings per request chain, this many
+# years at a time, starting from FIRST_LISTING_YEAR
+IMPORT_WORKERS = 8
+FIRST_LISTING_YEAR = 1980
+DICTIONARY_COLUMNS = [
+    "ticker",
+    "currency_code",
+    "ipo_status",
+    "primary_exchange",
+    "security_type",
+]
+
+
+def _paginate(session, url, params, max_pages=100):
+    """
+    Yield the results of a Polygon list endpoint, following the cursor in
+    each page's next_url until the last page (or max_pages) is reached.
+    """
+    for _ in range(max_pages):
+        response = session.get(url, params=params, timeout=30)
+        if response.status_code != 200:
+            return
+
+        results = response.json()
+        if not results.get("results"):
+            return
+        yield from results["results"]
+
+        next_url = results.get("next_url")
+        if not next_url:
+            return
+
+        # The cursor encodes the original query, so it is all the next
+        # request needs
+        next_url = urlparse(next_url)
+        cursor = parse_qs(next_url.query).get("cursor")
+        if not cursor:
+            return
+        url = next_url._replace(query="").geturl()
+        params = {"cursor": cursor[0]}
+
+
+def listing_year_windows(first_year, last_year):
+    """
+    Query parameters splitting IPOs into one window per listing year. The
+    first and last windows are open ended, so together they cover every
+    listing date.
+    """
+    windows = [
+        {"listing_date.gte": f"{year}-01-01", "listing_date.lte": f"{year}-12-31"}
+        for year in range(first_year, last_year + 1)
+    ]
+    del windows[0]["listing_date.gte"]
+    del windows[-1]["listing_date.lte"]
+    return windows
 
 
 def update_ipo_history():
-    connector = PolygonConnector()
+    connector = get_connector()
     output_path = os.path.join(os.getenv("EQUITY_META_DATA"), "ipos.gzip")
 
+    # Authenticate every request made through the session
+    _SESSION.headers["Authorization"] = f"Bearer {connector.client.API_KEY}"
+
     # Check if we have existing IPO data
     existing_ipos = None
     if os.path.exists(output_path):
@@ -21,33 +102,6 @@ def update_ipo_history():
             print(e)
             existing_ipos = None
 
-    # Create a function to make requests to the IPO endpoint
-    def get_ipos(params=None):
-        """
-        Make a request to the IPOs endpoint with the given parameters.
-        Returns the JSON response.
-        """
-        base_url = "https://api.polygon.io/vX/reference/ipos"
-
-        # Get the API key from the connector
-        api_key = connector.client.API_KEY
-
-        # Initialize parameters if None
-        if params is None:
-            params = {}
-
-        # Add API key to parameters
-        params["apiKey"] = api_key
-
-        # Make the request
-        response = requests.get(base_url, params=params)
-
-        # Check if request was successful
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return None
-
     # Determine what to update
     if existing_ipos is not None and not existing_ipos.empty:
         # Find the latest modified date we have in our data
@@ -69,45 +123,7 @@ def update_ipo_history():
                     "limit": 1000,
                 }
 
-                pagination_cursor = None
-                page_count = 0
-                max_pages = 100  # Safety limit
-
-                while page_count < max_pages:
-                    page_count += 1
-
-                    # If we have a pagination cursor, use it
-                    if pagination_cursor:
-                        params["cursor"] = pagination_cursor
-
-                    # Make the request
-                    response = get_ipos(params)
-
-                    # Process the IPO records
-                    if response and "results" in response and response["results"]:
-                        for ipo in response["results"]:
-                            new_ipo_records.append(ipo)
-
-                    else:
-                        break
-
-                    # Check if we have a next_url for pagination
-                    if "next_url" in response and response["next_url"]:
-                        # Extract the cursor from the next_url
-                        if "cursor=" in response["next_url"]:
-                            pagination_cursor = (
-                                response["next_url"].split("cursor=")[1].split("&")[0]
-                                if "&" in response["next_url"].split("cursor=")[1]
-                                else response["next_url"].split("cursor=")[1]
-                            )
-                            # Add a small delay to avoid hitting rate limits
-                            time.sleep(0.5)
-                        else:
-                            break
-                    else:
-                        # No more pages to fetch
-                        break
-
+                new_ipo_records.extend(_paginate(_SESSION, IPOS_URL, params))
             except Exception as e:
                 print(e)
 
@@ -128,16 +144,25 @@ def update_ipo_history():
                     "ticker" in new_records_df.columns
                     and "ticker" in existing_ipos.columns
                 ):
-                    updated_tickers = new_records_df["ticker"].unique()
-                    existing_filtered = existing_ipos[
+                    updated_tickers = set(new_records_df["ticker"].unique().tolist())
+                    existing_filtered = existing_ipos.loc[
                         ~existing_ipos["ticker"].isin(updated_tickers)
                     ]
 
-                    # Merge with new/updated data
-                    combined_df = pd.concat([existing_filtered, new_records_df])
+                    # Merge with new/updated data, putting the new columns in
+                    # the stored order; fields only present in the new records
+                    # are kept at the end
+                    new_records_df = new_records_df.reindex(
+                        columns=existing_filtered.columns.union(
+                            new_records_df.columns, sort=False
+                        )
+                    )
+                    combined_df = pd.concat(
+                        [existing_filtered, new_records_df], ignore_index=True
+                    )
 
                     # Save the updated dataset
-                    combined_df.to_parquet(path=output_path, index=False)
+                    write_parquet(combined_df, output_path, DICTIONARY_COLUMNS)
 
                     return combined_df
                 else:
@@ -153,49 +178,22 @@ def update_ipo_history():
         ipo_history = []
 
         try:
-            # Get all pages of IPO results
+            # Get all pages of IPO results. Following the cursor is serial,
+            # so scan each listing year separately and several years at once.
             params = {"sort": "listing_date", "order": "asc", "limit": 1000}
-
-            pagination_cursor = None
-            page_count = 0
-            max_pages = 100  # Safety limit
-
-            while page_count < max_pages:
-                page_count += 1
-
-                # If we have a pagination cursor, use it
-                if pagination_cursor:
-                    params["cursor"] = pagination_cursor
-
-                # Make the request
-                response = get_ipos(params)
-
-                # Process the IPO records
-                if response and "results" in response and response["results"]:
-                    for ipo in response["results"]:
-                        ipo_history.append(ipo)
-
-                else:
-                    break
-
-                # Check if we have a next_url for pagination
-                if "next_url" in response and response["next_url"]:
-                    # Extract the cursor from the next_url
-                    if "cursor=" in response["next_url"]:
-                        pagination_cursor = (
-                            response["next_url"].split("cursor=")[1].split("&")[0]
-                            if "&" in response["next_url"].split("cursor=")[1]
-                            else response["next_url"].split("cursor=")[1]
-                        )
-
-                        # Add a small delay to avoid hitting rate limits
-                        time.sleep(0.5)
-                    else:
-                        break
-                else:
-                    # No more pages to fetch
-                    break
-
+            windows = listing_year_windows(FIRST_LISTING_YEAR, datetime.now().year)
+
+            with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+                window_ipos = executor.map(
+                    lambda window: list(
+                        _paginate(_SESSION, IPOS_URL, {**params, **window})
+                    ),
+                    windows,
+                )
+                for ipos in tqdm(
+                    window_ipos, total=len(windows), desc="Getting all IPO history"
+                ):
+                    ipo_history.extend(ipos)
         except Exception as e:
             raise e
 
@@ -209,8 +207,13 @@ def update_ipo_history():
                 if col in ipo_history_df.columns:
                     ipo_history_df[col] = pd.to_datetime(ipo_history_df[col])
 
+            if "listing_date" in ipo_history_df.columns:
+                ipo_history_df = ipo_history_df.sort_values(
+                    "listing_date", kind="stable", ignore_index=True
+                )
+
             # Save the DataFrame
-            ipo_history_df.to_parquet(path=output_path, index=False)
+            write_parquet(ipo_history_df, output_path, DICTIONARY_COLUMNS)
 
         return ipo_history_df
 
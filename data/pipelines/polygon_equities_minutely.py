@@ -7,12 +7,80 @@ This script implements an ETL pipeline to download all available daily aggregate
 data for stocks from Polygon.io's Flat Files service.
 """
 
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from data.connectors.polygon_s3_connector import PolygonS3Connector
 import datetime
 from pathlib import Path
 from tqdm import tqdm
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+# Size of the CSV blocks parsed at a time, which bounds the memory used while
+# converting a day of minute bars
+CSV_BLOCK_SIZE = 64 << 20
+# Types of the minute aggregate columns. The streaming reader would otherwise
+# infer them from the first block only, and fail on a later block that
+# doesn't fit (e.g. a fractional value in a column inferred as int64)
+MINUTE_AGG_TYPES = {
+    "ticker": pa.string(),
+    "volume": pa.int64(),
+    "open": pa.float64(),
+    "close": pa.float64(),
+    "high": pa.float64(),
+    "low": pa.float64(),
+    "window_start": pa.int64(),
+    "transactions": pa.int64(),
+}
+# Number of days downloaded at once
+DOWNLOAD_WORKERS = 8
+
+
+def _csv_to_parquet(csv_path):
+    """
+    Convert a CSV file to parquet one block at a time, without loading the
+    whole file into memory. Returns the path of the parquet file.
+    """
+    parquet_path = str(csv_path).replace(".csv", ".gzip")
+    # write under a temporary name so that a failed conversion never leaves
+    # a truncated file that would later count as ingested
+    part_path = parquet_path + ".part"
+    reader = pacsv.open_csv(
+        csv_path,
+        read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pacsv.ConvertOptions(column_types=MINUTE_AGG_TYPES),
+    )
+    try:
+        with pq.ParquetWriter(part_path, reader.schema, compression="snappy") as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+        os.replace(part_path, parquet_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return parquet_path
+
+
+def _file_date(s3_key):
+    """Date (YYYY-MM-DD) of a flat file from its S3 key."""
+    name = s3_key.rsplit("/", 1)[-1]
+    return name[: name.find(".")]
+
+
+def _download_and_convert(conn, convert_pool, s3_key, local_path):
+    """
+    Download a day of minute bars and convert it to parquet in the process
+    pool. Runs in a download thread, which waits for the conversion so that
+    at most one CSV per thread is on disk at a time.
+    """
+    csv_path = conn.download_file(s3_key=s3_key, local_path=local_path, decompress=True)
+    parquet_path = convert_pool.submit(_csv_to_parquet, csv_path).result()
+    os.remove(csv_path)
+    return parquet_path
+
 
 if __name__ == "__main__":
     conn = PolygonS3Connector()
@@ -27,40 +95,51 @@ if __name__ == "__main__":
             daily_files = conn.list_data_by_category(
                 asset_class="stocks", data_type="minute_aggs", year=year, month=month
             )
+            # parse each file's date once, up front
+            for file in daily_files:
+                file["_date_str"] = _file_date(file["key"])
             all_files += daily_files
 
-    print("Filter out dates that cannot be accessed with current subscription")
-    # filter out dates I'm not allowed to download
-    for x in range(len(all_files) - 1, -1, -1):
-        s3_key = all_files[x]["key"]
-        file_name = Path(s3_key).name
-        file_date = file_name[: file_name.find(".")]
-        file_date = datetime.date.fromisoformat(file_date)
-        if file_date < max_allowed_date:
-            all_files.pop(x)
-
-    print("Filtering out dates that are already ingested")
-    # filter out dates that are already ingested
-    current_files = os.listdir(os.getenv("EQUITY_MINUTE_DATA_PATH"))
-    current_files = [cf[: cf.find(".gzip")] for cf in current_files]
-    for x in range(len(all_files) - 1, -1, -1):
-        curr_name = Path(all_files[x]["key"]).name
-        curr_name_date = curr_name[: curr_name.find(".csv.gz")]
-        if curr_name_date in current_files:
-            all_files.pop(x)
+    print("Filtering out dates that are already ingested or cannot be accessed")
+    # dates that are already ingested
+    with os.scandir(os.getenv("EQUITY_MINUTE_DATA_PATH")) as entries:
+        ingested = {
+            entry.name.split(".gzip", 1)[0]
+            for entry in entries
+            if entry.name.endswith(".gzip")
+        }
+    # filter out dates I'm not allowed to download and dates already ingested;
+    # ISO dates compare correctly as strings
+    min_date_str = max_allowed_date.isoformat()
+    all_files = [
+        file
+        for file in all_files
+        if file["_date_str"] >= min_date_str and file["_date_str"] not in ingested
+    ]
 
     print("Downloading files")
-    for file in tqdm(all_files, desc="downloading files"):
-        s3_key = file["key"]
-        base_save_path = os.getenv("EQUITY_MINUTE_DATA_PATH")
-        name_path = Path(s3_key).name
-        output_path = conn.download_file(
-            s3_key=s3_key,
-            local_path=base_save_path + "/" + name_path,
-            decompress=True,
-        )
-        data = pd.read_csv(output_path)
-        data.to_parquet(str(output_path).replace(".csv", ".gzip"))
-        os.remove(output_path)
+    base_save_path = os.getenv("EQUITY_MINUTE_DATA_PATH")
+    # downloading is network bound and converting CPU bound, so run them in
+    # separate pools and convert each day while the next ones download.
+    # The converters start from within the download threads, which forking
+    # could deadlock on a lock held by another thread, so use a forkserver
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as download_pool:
+        with ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("forkserver")
+        ) as convert_pool:
+            futures = [
+                download_pool.submit(
+                    _download_and_convert,
+                    conn,
+                    convert_pool,
+                    file["key"],
+                    base_save_path + "/" + Path(file["key"]).name,
+                )
+                for file in all_files
+            ]
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="downloading files"
+            ):
+                future.result()
 
     print("Successfully downloaded all data")
@@ -1,19 +1,84 @@
-from data.connectors.polygon_connector import PolygonConnector
+from data.connectors import get_connector
+from data.pipelines.common import (
+    drop_duplicate_keys,
+    ensure_dt,
+    fetch_concurrently,
+    load_last_checked,
+    stale_from_dates,
+    write_last_checked,
+    write_parquet,
+)
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 import os
 from datetime import datetime, timedelta
 import logging
-import time
+
+# Columns identifying a split
+KEY_COLUMNS = ["ticker", "execution_date", "split_from", "split_to"]
+DICTIONARY_COLUMNS = ["ticker"]
+# Tickers whose splits were fetched more recently than this (or up to half
+# of it, see is_stale) are skipped
+LAST_CHECKED_TTL = timedelta(days=30)
+
+
+def fetch_splits(connector, tickers, desc, from_dates=None):
+    """
+    Fetch the splits of every ticker concurrently, oldest first.
+
+    `from_dates` maps tickers to the earliest execution date (YYYY-MM-DD) to
+    fetch; tickers missing from it get their whole history.
+
+    Returns one dict per split and the set of tickers that were fetched
+    successfully.
+    """
+    from_dates = from_dates or {}
+
+    def params_for(ticker):
+        params = dict(
+            ticker=ticker,
+            sort="execution_date",
+            order="asc",
+            limit=1000,  # Maximum allowed by API
+        )
+        if ticker in from_dates:
+            params["execution_date_gte"] = from_dates[ticker]
+        return params
+
+    records = []
+    fetched = set()
+    for ticker, splits in fetch_concurrently(
+        connector, connector.client.list_splits, tickers, desc, params_for
+    ):
+        for split in splits:
+            if split:
+                records.append(split.__dict__)
+        fetched.add(ticker)
+
+    return records, fetched
+
+
+def split_ratio(splits_df):
+    """split_to / split_from of every split, as a plain float64 array."""
+    split_to = splits_df["split_to"].to_numpy(dtype=np.float64, na_value=np.nan)
+    split_from = splits_df["split_from"].to_numpy(dtype=np.float64, na_value=np.nan)
+    return split_to / split_from
 
 
 def update_split_history():
-    connector = PolygonConnector()
+    connector = get_connector()
     output_path = os.path.join(os.getenv("EQUITY_META_DATA"), "splits.gzip")
+    last_checked_path = os.path.join(
+        os.getenv("EQUITY_META_DATA"), "splits_last_checked.parquet"
+    )
+    last_checked = load_last_checked(last_checked_path, "ticker")
+    now = datetime.now()
 
     # Load all tickers
     all_tickers = pd.read_csv(
-        os.path.join(os.getenv("EQUITY_META_DATA"), "all_ticker_meta.csv")
+        os.path.join(os.getenv("EQUITY_META_DATA"), "all_ticker_meta.csv"),
+        usecols=["ticker"],
+        engine="pyarrow",
     )
     all_tickers_list = all_tickers["ticker"].drop_duplicates().tolist()
 
@@ -30,115 +95,79 @@ def update_split_history():
     # Determine what to update
     if existing_splits is not None and not existing_splits.empty:
         # Find the latest execution_date we have in our data
-        latest_split_date = pd.to_datetime(existing_splits["execution_date"]).max()
+        existing_splits["execution_date"] = ensure_dt(existing_splits["execution_date"])
+        latest_split_date = existing_splits["execution_date"].max()
 
         # Use a buffer of 7 days to ensure we don't miss any splits due to data delays
         from_date = (latest_split_date - timedelta(days=7)).strftime("%Y-%m-%d")
 
-        # Process all tickers but only fetch newer split records
-        new_split_records = []
-
-        # Split tickers into batches to avoid rate limiting
-        batch_size = 100
-        ticker_batches = [
-            all_tickers_list[i : i + batch_size]
-            for i in range(0, len(all_tickers_list), batch_size)
-        ]
-
-        for batch in tqdm(ticker_batches, desc="Processing ticker batches"):
-            for ticker in tqdm(batch, desc="Updating split history", leave=False):
-                try:
-                    # Use the execution_date_gte parameter to get splits after our latest date
-                    # Sort by execution_date in ascending order to get oldest first
-                    for split in connector.client.list_splits(
-                        ticker=ticker,
-                        execution_date_gte=from_date,
-                        sort="execution_date",
-                        order="asc",
-                        limit=1000,  # Maximum allowed by API
-                    ):
-                        if split:
-                            new_split_records.append(split.__dict__)
-                except Exception as e:
-                    print(e)
-
-            # Add a small delay between batches to avoid rate limiting
-            time.sleep(1)
+        # Skip tickers whose splits were fetched recently, the others only
+        # fetch newer split records
+        from_dates = stale_from_dates(
+            all_tickers_list, last_checked, from_date, now, LAST_CHECKED_TTL
+        )
+
+        new_split_records, fetched = fetch_splits(
+            connector,
+            list(from_dates),
+            "Updating split history",
+            from_dates=from_dates,
+        )
+        last_checked.update(dict.fromkeys(fetched, now))
 
         # Convert new records to DataFrame
         if new_split_records:
             new_records_df = pd.DataFrame(new_split_records)
 
             # Calculate the ratio for new records
-            new_records_df["ratio"] = (
-                new_records_df["split_to"] / new_records_df["split_from"]
-            )
+            new_records_df["ratio"] = split_ratio(new_records_df)
 
             # Drop any duplicate records before merging
             # First ensure the execution_date is in datetime format for comparison
             if "execution_date" in new_records_df.columns:
-                new_records_df["execution_date"] = pd.to_datetime(
+                new_records_df["execution_date"] = ensure_dt(
                     new_records_df["execution_date"]
                 )
 
-            # Do the same for the existing data
-            existing_splits["execution_date"] = pd.to_datetime(
-                existing_splits["execution_date"]
+            # Merge with existing data, lining the new columns up with the
+            # stored ones so the frames are stacked without realignment
+            new_records_df = new_records_df.reindex(columns=existing_splits.columns)
+            combined_df = pd.concat(
+                [existing_splits, new_records_df], ignore_index=True
             )
 
-            # Merge with existing data
-            combined_df = pd.concat([existing_splits, new_records_df])
-
-            # Remove duplicates based on ticker and execution_date, and split ratio values
-            combined_df = combined_df.drop_duplicates(
-                subset=["ticker", "execution_date", "split_from", "split_to"]
-            )
+            # Remove duplicates based on ticker and execution_date, and split
+            # ratio values, keeping the most recently fetched record
+            combined_df = drop_duplicate_keys(combined_df, KEY_COLUMNS, keep="last")
 
             # Save the updated dataset
-            combined_df.to_parquet(path=output_path, index=False)
-
-            return combined_df
+            write_parquet(combined_df, output_path, DICTIONARY_COLUMNS)
         else:
-            return existing_splits
+            combined_df = existing_splits
+
+        # Only record the fetches once their splits are saved, otherwise a
+        # failed run would skip those tickers until they go stale again
+        write_last_checked(last_checked, last_checked_path, "ticker")
+
+        return combined_df
     else:
         # Initial import - we'll fetch all historical splits
-        split_history = []
-
-        # Split tickers into batches
-        batch_size = 100
-        ticker_batches = [
-            all_tickers_list[i : i + batch_size]
-            for i in range(0, len(all_tickers_list), batch_size)
-        ]
-
-        for batch in tqdm(ticker_batches, desc="Processing ticker batches"):
-            for ticker in tqdm(batch, desc="Getting all split history", leave=False):
-                try:
-                    # We need to fetch all split history for initial import
-                    for split in connector.client.list_splits(
-                        ticker=ticker,
-                        limit=1000,  # Maximum allowed by API
-                        sort="execution_date",
-                        order="asc",
-                    ):
-                        if split:
-                            split_history.append(split.__dict__)
-                except Exception as e:
-                    print(e)
-
-            # Add a small delay between batches to avoid rate limiting
-            time.sleep(1)
+        split_history, fetched = fetch_splits(
+            connector, all_tickers_list, "Getting all split history"
+        )
+        last_checked.update(dict.fromkeys(fetched, now))
 
         # Create DataFrame and save
         split_history_df = pd.DataFrame(split_history)
 
         if not split_history_df.empty:
             # Calculate the split ratio
-            split_history_df["ratio"] = (
-                split_history_df["split_to"] / split_history_df["split_from"]
-            )
+            split_history_df["ratio"] = split_ratio(split_history_df)
+
+            write_parquet(split_history_df, output_path, DICTIONARY_COLUMNS)
 
-            split_history_df.to_parquet(path=output_path, index=False)
+        # Only record the fetches once their splits are saved
+        write_last_checked(last_checked, last_checked_path, "ticker")
 
         return split_history_df
 
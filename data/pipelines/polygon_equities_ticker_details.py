@@ -1,28 +1,51 @@
-from data.connectors.polygon_connector import PolygonConnector
+from data.connectors import get_connector
 import pandas as pd
+import pyarrow as pa
 from tqdm import tqdm
 import os
+from dataclasses import fields
+from polygon.rest.models import Ticker
 
-connector = PolygonConnector()
+TICKER_FIELDS = [field.name for field in fields(Ticker)]
 
 if __name__ == "__main__":
+    connector = get_connector()
+
     # fetch all tickers
-    all_tickers = list()
+    # collect one list per column rather than one dict per ticker
+    columns = {name: [] for name in TICKER_FIELDS}
     for tick in tqdm(connector.client.list_tickers(market="stocks")):
-        all_tickers.append(tick.__dict__)
-    all_tickers = pd.DataFrame.from_records(all_tickers)
+        for name, values in columns.items():
+            values.append(getattr(tick, name, None))
+    all_tickers = pa.table(columns)
+    # drop fields the API never returned, which would otherwise mark every
+    # record as incomplete
+    all_tickers = all_tickers.select(
+        [
+            name
+            for name in all_tickers.column_names
+            if all_tickers[name].null_count < all_tickers.num_rows
+        ]
+    ).to_pandas(self_destruct=True)
     all_tickers = all_tickers.sort_values("ticker")
 
-    # fully filled in ticker records
+    # fully filled in ticker records, keeping the most recently updated
+    # record among those that only differ in last_updated_utc
     ins = all_tickers.dropna()
-    ins = ins.sort_values("last_updated_utc").drop_duplicates(
-        subset=all_tickers.columns[:-1], keep="last"
-    )
+    last_updated = pd.to_datetime(ins["last_updated_utc"], utc=True)
+    key_columns = [
+        column for column in all_tickers.columns if column != "last_updated_utc"
+    ]
+    ins = ins.loc[
+        last_updated.groupby([ins[column] for column in key_columns], sort=False)
+        .idxmax()
+        .to_numpy()
+    ]
 
     # reamining records (with null)
     remaining = all_tickers[all_tickers.isna().any(axis=1)]
-    full_label = ins["ticker"] + "|" + ins["name"]
-    remaining_label = remaining["ticker"] + "|" + remaining["name"]
+    full_label = pd.MultiIndex.from_frame(ins[["ticker", "name"]])
+    remaining_label = pd.MultiIndex.from_frame(remaining[["ticker", "name"]])
     # get rid of combinations we are already familiar with
     remaining = remaining[~remaining_label.isin(full_label)]
     finale = pd.concat([ins, remaining])
@@ -1,10 +1,71 @@
-from data.connectors.polygon_connector import PolygonConnector
+from data.connectors import get_connector
+from data.pipelines.common import (
+    drop_duplicate_keys,
+    ensure_dt,
+    fetch_concurrently,
+    load_last_checked,
+    stale_from_dates,
+    write_last_checked,
+    write_parquet,
+)
 import pandas as pd
-from tqdm import tqdm
 import os
 from datetime import datetime, timedelta
 import logging
-import time
+
+# Columns of the stored events
+EVENT_COLUMNS = ["name", "composite_figi", "cik", "new_ticker", "type", "date"]
+# Columns identifying an event
+KEY_COLUMNS = ["composite_figi", "type", "date", "new_ticker"]
+DICTIONARY_COLUMNS = ["name", "composite_figi", "cik", "new_ticker", "type"]
+# FIGIs whose events were fetched more recently than this (or up to half of
+# it, see is_stale) are skipped
+LAST_CHECKED_TTL = timedelta(days=30)
+
+
+def fetch_ticker_events(connector, figis, desc):
+    """
+    Fetch the ticker events of every FIGI concurrently. Yields (figi, events)
+    pairs as the requests complete.
+    """
+    return fetch_concurrently(
+        connector,
+        connector.client.get_ticker_events,
+        figis,
+        desc,
+        lambda figi: dict(ticker=figi),
+        paginated=False,
+    )
+
+
+def append_events(columns, events, from_date=None):
+    """
+    Append the events of one FIGI to `columns`, which holds one list per
+    column. When `from_date` (YYYY-MM-DD) is given, older events are skipped,
+    as are malformed events.
+    """
+    cik = getattr(events, "cik", None)
+    for row in events.events:
+        # read every field before appending any, so that a malformed event
+        # is skipped without leaving the columns with different lengths
+        try:
+            new_ticker = row["ticker_change"]["ticker"]
+            event_type = row["type"]
+            event_date = row["date"]
+            # both dates are ISO formatted, so they compare correctly as strings
+            if from_date is not None and event_date < from_date:
+                continue
+        except (KeyError, TypeError) as e:
+            logging.getLogger(__name__).warning(
+                f"Skipping malformed event of FIGI {events.composite_figi}: {e!r}"
+            )
+            continue
+        columns["name"].append(events.name)
+        columns["composite_figi"].append(events.composite_figi)
+        columns["cik"].append(cik)
+        columns["new_ticker"].append(new_ticker)
+        columns["type"].append(event_type)
+        columns["date"].append(event_date)
 
 
 def update_ticker_events():
@@ -14,12 +75,19 @@ def update_ticker_events():
     )
     logger = logging.getLogger(__name__)
 
-    connector = PolygonConnector()
+    connector = get_connector()
     output_path = os.path.join(os.getenv("EQUITY_META_DATA"), "ticker_events.gzip")
+    last_checked_path = os.path.join(
+        os.getenv("EQUITY_META_DATA"), "ticker_events_last_checked.parquet"
+    )
+    last_checked = load_last_checked(last_checked_path, "composite_figi")
+    now = datetime.now()
 
     # Load all tickers with their FIGIs
     all_tickers = pd.read_csv(
-        os.path.join(os.getenv("EQUITY_META_DATA"), "all_ticker_meta.csv")
+        os.path.join(os.getenv("EQUITY_META_DATA"), "all_ticker_meta.csv"),
+        usecols=["composite_figi"],
+        engine="pyarrow",
     )
 
     # Get valid FIGIs
@@ -41,7 +109,8 @@ def update_ticker_events():
     # Determine what to update
     if existing_events is not None and not existing_events.empty:
         # Find the latest date we have in our data
-        latest_event_date = pd.to_datetime(existing_events["date"]).max()
+        existing_events["date"] = ensure_dt(existing_events["date"])
+        latest_event_date = existing_events["date"].max()
 
         # Use a buffer of 7 days to ensure we don't miss any events due to data delays
         from_date = (latest_event_date - timedelta(days=7)).strftime("%Y-%m-%d")
@@ -51,122 +120,80 @@ def update_ticker_events():
         # Get FIGIs we already have data for
         processed_figis = set(existing_events["composite_figi"].dropna().unique())
 
-        # Process all FIGIs
-        event_history = []
-
-        # Split FIGIs into batches to avoid rate limiting
-        batch_size = 100
-        figi_batches = [
-            figis[i : i + batch_size] for i in range(0, len(figis), batch_size)
-        ]
-
-        for batch in tqdm(figi_batches, desc="Processing FIGI batches"):
-            for figi in tqdm(batch, desc="Updating ticker events", leave=False):
-                try:
-                    # Get ticker events for this FIGI
-                    events = connector.client.get_ticker_events(ticker=figi)
-
-                    if events and hasattr(events, "events") and events.events:
-                        # Process each event
-                        collection = []
-                        for row in events.events:
-                            # Check if this is a new event
-                            event_date = pd.to_datetime(row["date"])
-                            if (
-                                event_date >= pd.to_datetime(from_date)
-                                or figi not in processed_figis
-                            ):
-                                collection_dict = dict()
-                                collection_dict["name"] = events.name
-                                collection_dict["composite_figi"] = (
-                                    events.composite_figi
-                                )
-                                collection_dict["cik"] = getattr(events, "cik", None)
-                                collection_dict["new_ticker"] = row["ticker_change"][
-                                    "ticker"
-                                ]
-                                collection_dict["type"] = row["type"]
-                                collection_dict["date"] = row["date"]
-                                collection.append(collection_dict)
-
-                        # Add to our event history
-                        event_history.extend(collection)
-                except Exception as e:
-                    logger.error(f"Error fetching events for FIGI {figi}: {e}")
-
-            # Add a small delay between batches to avoid rate limiting
-            time.sleep(1)
+        # Skip FIGIs whose events were fetched recently, the others only
+        # keep newer events
+        from_dates = stale_from_dates(
+            figis, last_checked, from_date, now, LAST_CHECKED_TTL
+        )
+        logger.info(f"{len(from_dates)} FIGIs weren't checked recently")
+
+        # Process the stale FIGIs, collecting one list per column
+        event_history = {name: [] for name in EVENT_COLUMNS}
+
+        for figi, events in fetch_ticker_events(
+            connector, list(from_dates), "Updating ticker events"
+        ):
+            try:
+                if events and hasattr(events, "events") and events.events:
+                    # Only keep new events, unless the FIGI is new to us
+                    append_events(
+                        event_history,
+                        events,
+                        from_dates[figi] if figi in processed_figis else None,
+                    )
+                last_checked[figi] = now
+            except Exception as e:
+                logger.error(f"Error processing events for FIGI {figi}: {e}")
 
         # Convert new records to DataFrame
-        if event_history:
+        if event_history["date"]:
             new_records_df = pd.DataFrame(event_history)
             logger.info(f"Found {len(new_records_df)} new ticker event records")
 
             # Convert date to datetime for comparison
-            new_records_df["date"] = pd.to_datetime(new_records_df["date"])
-            existing_events["date"] = pd.to_datetime(existing_events["date"])
+            new_records_df["date"] = ensure_dt(new_records_df["date"])
 
             # Remove any events in our new data that already exist in our old data
-            combined_df = pd.concat([existing_events, new_records_df])
-
-            # Remove duplicates
-            combined_df = combined_df.drop_duplicates(
-                subset=["composite_figi", "type", "date", "new_ticker"]
+            new_records_df = new_records_df.reindex(columns=existing_events.columns)
+            combined_df = pd.concat(
+                [existing_events, new_records_df], ignore_index=True
             )
 
+            # Remove duplicates, keeping the most recently fetched record
+            combined_df = drop_duplicate_keys(combined_df, KEY_COLUMNS, keep="last")
+
             # Save the updated dataset
-            combined_df.to_parquet(path=output_path, index=False)
+            write_parquet(combined_df, output_path, DICTIONARY_COLUMNS)
             logger.info(
                 f"Saved updated ticker events data with {len(combined_df)} total records"
             )
-
-            return combined_df
         else:
             logger.info("No new ticker event records found")
-            return existing_events
+            combined_df = existing_events
+
+        # Only record the fetches once their events are saved, otherwise a
+        # failed run would skip those FIGIs until they go stale again
+        write_last_checked(last_checked, last_checked_path, "composite_figi")
+
+        return combined_df
     else:
         # No existing data, collect all ticker events
         logger.info(
             "No existing ticker events data found. Collecting all ticker events history."
         )
 
-        # Process all FIGIs
-        event_history = []
-
-        # Split FIGIs into batches to avoid rate limiting
-        batch_size = 100
-        figi_batches = [
-            figis[i : i + batch_size] for i in range(0, len(figis), batch_size)
-        ]
-
-        for batch in tqdm(figi_batches, desc="Processing FIGI batches"):
-            for figi in tqdm(batch, desc="Getting all ticker events", leave=False):
-                try:
-                    # Get ticker events for this FIGI
-                    events = connector.client.get_ticker_events(ticker=figi)
-
-                    if events and hasattr(events, "events") and events.events:
-                        # Process each event
-                        collection = []
-                        for row in events.events:
-                            collection_dict = dict()
-                            collection_dict["name"] = events.name
-                            collection_dict["composite_figi"] = events.composite_figi
-                            collection_dict["cik"] = getattr(events, "cik", None)
-                            collection_dict["new_ticker"] = row["ticker_change"][
-                                "ticker"
-                            ]
-                            collection_dict["type"] = row["type"]
-                            collection_dict["date"] = row["date"]
-                            collection.append(collection_dict)
-
-                        # Add to our event history
-                        event_history.extend(collection)
-                except Exception as e:
-                    logger.error(f"Error fetching events for FIGI {figi}: {e}")
-
-            # Add a small delay between batches to avoid rate limiting
-            time.sleep(1)
+        # Process all FIGIs, collecting one list per column
+        event_history = {name: [] for name in EVENT_COLUMNS}
+
+        for figi, events in fetch_ticker_events(
+            connector, figis, "Getting all ticker events"
+        ):
+            try:
+                if events and hasattr(events, "events") and events.events:
+                    append_events(event_history, events)
+                last_checked[figi] = now
+            except Exception as e:
+                logger.error(f"Error processing events for FIGI {figi}: {e}")
 
         # Create DataFrame from collected events
         event_history_df = pd.DataFrame(event_history)
@@ -174,21 +201,22 @@ def update_ticker_events():
         # Save the data if we have any events
         if not event_history_df.empty:
             # Convert date to datetime
-            event_history_df["date"] = pd.to_datetime(event_history_df["date"])
+            event_history_df["date"] = ensure_dt(event_history_df["date"])
 
             # Remove duplicates
-            event_history_df = event_history_df.drop_duplicates(
-                subset=["composite_figi", "type", "date", "new_ticker"]
-            )
+            event_history_df = drop_duplicate_keys(event_history_df, KEY_COLUMNS)
 
             # Save the DataFrame
-            event_history_df.to_parquet(path=output_path, index=False)
+            write_parquet(event_history_df, output_path, DICTIONARY_COLUMNS)
             logger.info(
                 f"Saved initial ticker events data with {len(event_history_df)} records"
             )
         else:
             logger.warning("No ticker events data collected")
 
+        # Only record the fetches once their events are saved
+        write_last_checked(last_checked, last_checked_path, "composite_figi")
+
         return event_history_df
 
 